@@ -1,6 +1,5 @@
 import os
 import uuid
-import sqlite3
 import logging
 import requests
 import pytz
@@ -11,7 +10,9 @@ from urllib.parse import urlencode
 from datetime import datetime, timezone
 from openai import OpenAI
 from flask import Flask, request, redirect, session, url_for, jsonify, make_response, render_template
-from log_utils import setup_logging
+from log_utils import setup_logging, set_trace_id, get_trace_id, RateLimitFilter
+import db
+import job_manager
 from dotenv import load_dotenv
 import json
 
@@ -31,21 +32,27 @@ JWT_EXPIRATION_SECS   = int(os.getenv("JWT_EXPIRATION_MINUTES", "15")) * 60
 
 PACIFIC               = pytz.timezone("America/Los_Angeles")
 UPLOAD_DIR            = "doc_store"
-DB_PATH               = "jobs.db"
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-logger = setup_logging("API Gateway") or logging.getLogger("api_gateway")
+CENTRAL_LOG_URL       = os.getenv("CENTRAL_LOG_URL", "http://localhost:5020/log")
+
+logger = setup_logging("API Gateway", central_url=CENTRAL_LOG_URL) or logging.getLogger("api_gateway")
 logger.setLevel(logging.INFO)
 
-def log_to_central(service: str, level: str, message: str):
-    try:
-        requests.post("http://localhost:5020/log",
-                      json={"service": service, "level": level, "message": message},
-                      timeout=2)
-    except Exception as e:
-        logger.error(f"Failed to log to central: {e}")
+# /ping is hit by health checks and load balancers; rate-limit its log lines
+# (local and central) to this many per minute (0 = no limit).
+PING_LOG_LIMIT        = int(os.getenv("PING_LOG_LIMIT", "30"))
+ping_limit            = RateLimitFilter(PING_LOG_LIMIT) if PING_LOG_LIMIT > 0 else None
+
+def log_event(service: str, level: str, msg: str, *args):
+    """Log locally and centrally (as `service`) with lazy %-args.
 
+    The central copy is posted by log_utils.CentralLogHandler on the logging
+    thread, so anything dropped by level, sampling or rate limits is neither
+    formatted nor posted.
+    """
+    logger.log(logging.getLevelName(level), msg, *args, extra={"central_service": service})
 
 
 def create_app():
@@ -73,6 +80,11 @@ def create_app():
         
     app.jinja_env.filters['datetime_fmt'] = datetime_fmt
 
+    @app.before_request
+    def bind_trace_id():
+        # Honour an upstream request id so logs correlate across services
+        set_trace_id(request.headers.get("X-Request-ID"))
+
     def is_logged_in() -> bool:
         return "id_token" in session
 
@@ -86,8 +98,7 @@ def create_app():
             token_hash = hashlib.sha256(token.encode()).hexdigest()[:12]
 
             claims = jwt.decode(token, options={"verify_signature": False})
-            logger.info(f"[verify_id_token] TokenHash={token_hash} Decoded claims: {claims}")
-            log_to_central("Identity", "DEBUG", f"[verify_id_token] TokenHash={token_hash} Claims: {claims}")
+            log_event("Identity", "DEBUG", "[verify_id_token] TokenHash=%s Decoded claims: %s", token_hash, claims)
 
             # Trace the subject (user) as soon as we can
             sub = claims.get("sub", "(none)")
@@ -98,16 +109,14 @@ def create_app():
 
             # Audience check
             if aud != OIDC_CLIENT_ID:
-                msg = f"Audience mismatch: got {aud}, expected {OIDC_CLIENT_ID} (sub={sub}, TokenHash={token_hash})"
-                logger.error(msg)
-                log_to_central("Identity", "ERROR", msg)
+                log_event("Identity", "ERROR", "Audience mismatch: got %s, expected %s (sub=%s, TokenHash=%s)",
+                          aud, OIDC_CLIENT_ID, sub, token_hash)
                 raise ValueError("Invalid audience")
 
             # Issuer check
             if iss != OIDC_ISSUER:
-                msg = f"Issuer mismatch: got {iss}, expected {OIDC_ISSUER} (sub={sub}, TokenHash={token_hash})"
-                logger.error(msg)
-                log_to_central("Identity", "ERROR", msg)
+                log_event("Identity", "ERROR", "Issuer mismatch: got %s, expected %s (sub=%s, TokenHash=%s)",
+                          iss, OIDC_ISSUER, sub, token_hash)
                 raise ValueError("Invalid issuer")
 
             # Expiry check
@@ -115,20 +124,18 @@ def create_app():
             if exp and exp < now:
                 exp_str = datetime.utcfromtimestamp(exp).isoformat() + "Z"
                 iat_str = datetime.utcfromtimestamp(iat).isoformat() + "Z" if iat else "(unknown)"
-                msg = f"Token expired at {exp_str}, issued at {iat_str}, now={datetime.utcfromtimestamp(now).isoformat()}Z (sub={sub}, TokenHash={token_hash})"
-                logger.error(msg)
-                log_to_central("Identity", "ERROR", msg)
+                now_str = datetime.utcfromtimestamp(now).isoformat() + "Z"
+                log_event("Identity", "ERROR", "Token expired at %s, issued at %s, now=%s (sub=%s, TokenHash=%s)",
+                          exp_str, iat_str, now_str, sub, token_hash)
                 raise ValueError("ID token expired")
 
             elapsed = round(time.time() - start, 4)
-            msg = f"[verify_id_token] Token valid for sub={sub} (TokenHash={token_hash}), checked in {elapsed}s"
-            logger.info(msg)
-            log_to_central("Identity", "INFO", msg)
+            log_event("Identity", "INFO", "[verify_id_token] Token valid for sub=%s (TokenHash=%s), checked in %ss",
+                      sub, token_hash, elapsed)
             return claims
 
         except Exception as e:
-            logger.error(f"[verify_id_token] JWT verification failed: {e}")
-            log_to_central("Identity", "ERROR", f"[verify_id_token] JWT verification failed: {e}")
+            log_event("Identity", "ERROR", "[verify_id_token] JWT verification failed: %s", e)
             raise ValueError(f"Invalid token: {str(e)}")
 
     def require_login():
@@ -139,7 +146,7 @@ def create_app():
             return user
         except ValueError as e:
             session.clear()
-            logger.warning(f"ID token validation failed: {e}")
+            logger.warning("ID token validation failed: %s", e)
             return redirect(url_for("login"))
 
     @app.route("/login")
@@ -163,18 +170,16 @@ def create_app():
         ua = request.headers.get("User-Agent", "(none)")
         sess_id = session.get('_id', 'no-session-id')  # Flask does not use '_id' by default, just example
 
-        log_msg = (f"[login] Redirecting to OIDC auth: state={state}, ip={ip}, ua={ua}, "
-                f"session_id={sess_id}, params={params}")
-
-        logger.info(log_msg)
-        log_to_central("Identity", "INFO", log_msg)
+        log_event("Identity", "INFO",
+                  "[login] Redirecting to OIDC auth: state=%s, ip=%s, ua=%s, session_id=%s, params=%s",
+                  state, ip, ua, sess_id, params)
 
         return redirect(url)
 
     @app.route("/callback")
     def callback():
         start = time.time()
-        trace_id = str(uuid.uuid4())  # Use per-request trace for log correlation
+        trace_id = get_trace_id()  # Per-request trace for log correlation
         ip = request.remote_addr
         ua = request.headers.get("User-Agent", "")
         session_id = session.get("session_id", "-")
@@ -182,9 +187,8 @@ def create_app():
         # Step 1: Error from OIDC
         if "error" in request.args:
             err = request.args.get("error")
-            msg = f"[callback] OIDC error: {err} | ip={ip}, ua={ua}, session_id={session_id}, trace_id={trace_id}"
-            logger.error(msg)
-            log_to_central("Auth-Client", "ERROR", msg)
+            log_event("Auth-Client", "ERROR", "[callback] OIDC error: %s | ip=%s, ua=%s, session_id=%s, trace_id=%s",
+                      err, ip, ua, session_id, trace_id)
             return f"OIDC returned error: {err}", 400
 
         code = request.args.get("code")
@@ -192,10 +196,10 @@ def create_app():
         code_hash = hashlib.sha256((code or "no-code").encode()).hexdigest()[:12] if code else "-"
         expected_state = session.get("oidc_state")
         if not code or not state or state != expected_state:
-            msg = (f"[callback] Missing/invalid state or code | code_hash={code_hash}, state={state}, expected_state={expected_state}, "
-                f"ip={ip}, ua={ua}, session_id={session_id}, trace_id={trace_id}")
-            logger.error(msg)
-            log_to_central("Auth-Client", "ERROR", msg)
+            log_event("Auth-Client", "ERROR",
+                      "[callback] Missing/invalid state or code | code_hash=%s, state=%s, expected_state=%s, "
+                      "ip=%s, ua=%s, session_id=%s, trace_id=%s",
+                      code_hash, state, expected_state, ip, ua, session_id, trace_id)
             return "Missing or invalid state or code", 400
 
         token_req = {
@@ -210,28 +214,28 @@ def create_app():
             r.raise_for_status()
         except Exception as e:
             body = getattr(r, 'text', None)
-            msg = (f"[callback] Token request failed: {e} | body={body}, code_hash={code_hash}, ip={ip}, ua={ua}, "
-                f"session_id={session_id}, trace_id={trace_id}")
-            logger.error(msg)
-            log_to_central("Auth-Client", "ERROR", msg)
+            log_event("Auth-Client", "ERROR",
+                      "[callback] Token request failed: %s | body=%s, code_hash=%s, ip=%s, ua=%s, "
+                      "session_id=%s, trace_id=%s",
+                      e, body, code_hash, ip, ua, session_id, trace_id)
             return f"Token exchange error: {e}", 502
 
         td = r.json()
         id_token = td.get("id_token")
         if not id_token:
-            msg = (f"[callback] No id_token in token response: {td}, code_hash={code_hash}, "
-                f"ip={ip}, ua={ua}, session_id={session_id}, trace_id={trace_id}")
-            logger.error(msg)
-            log_to_central("Auth-Client", "ERROR", msg)
+            log_event("Auth-Client", "ERROR",
+                      "[callback] No id_token in token response: %s, code_hash=%s, "
+                      "ip=%s, ua=%s, session_id=%s, trace_id=%s",
+                      td, code_hash, ip, ua, session_id, trace_id)
             return "Token endpoint did not return id_token", 502
 
         try:
             claims = verify_id_token(id_token)
         except ValueError as e:
-            msg = (f"[callback] ID token invalid: {e}, code_hash={code_hash}, ip={ip}, ua={ua}, "
-                f"session_id={session_id}, trace_id={trace_id}")
-            logger.error(msg)
-            log_to_central("Auth-Client", "ERROR", msg)
+            log_event("Auth-Client", "ERROR",
+                      "[callback] ID token invalid: %s, code_hash=%s, ip=%s, ua=%s, "
+                      "session_id=%s, trace_id=%s",
+                      e, code_hash, ip, ua, session_id, trace_id)
             return f"ID token invalid: {str(e)}", 401
 
         session["id_token"] = id_token
@@ -248,11 +252,11 @@ def create_app():
         if "picture" in claims: user["picture"] = claims.get("picture")
 
         elapsed = round(time.time() - start, 4)
-        msg = (f"[callback] Login success: sub={user.get('sub')}, email={user.get('email', '-')}, aud={user['aud']}, "
-            f"code_hash={code_hash}, ip={ip}, ua={ua}, session_id={session_id}, trace_id={trace_id}, "
-            f"timing={elapsed}s")
-        logger.info(msg)
-        log_to_central("Auth-Client", "INFO", msg)
+        log_event("Auth-Client", "INFO",
+                  "[callback] Login success: sub=%s, email=%s, aud=%s, "
+                  "code_hash=%s, ip=%s, ua=%s, session_id=%s, trace_id=%s, timing=%ss",
+                  user.get('sub'), user.get('email', '-'), user['aud'],
+                  code_hash, ip, ua, session_id, trace_id, elapsed)
 
         return redirect(url_for("home"))
 
@@ -266,7 +270,7 @@ def create_app():
     def home():
         user = require_login()
         if not isinstance(user, dict): return user
-        with sqlite3.connect(DB_PATH) as conn:
+        with db.get_conn(db.JOBS_DB) as conn:
             jobs = conn.execute(
                 "SELECT id, filename, status, result FROM jobs ORDER BY created_at DESC"
             ).fetchall()
@@ -284,13 +288,14 @@ def create_app():
                 filename = f"{job_id}_{file.filename}"
                 store_fn = os.path.join(UPLOAD_DIR, filename)
                 file.save(store_fn)
-                with sqlite3.connect(DB_PATH) as conn:
-                    conn.execute(
-                        "INSERT INTO jobs (id, filename, status) VALUES (?, ?, ?)",
-                        (job_id, filename, "queued")
-                    )
-                logger.info(f"Uploaded: {filename}")
-                log_to_central("Parser", "INFO", f"Uploaded file: {filename}")
+                # Uploads always enter at normal priority; users cannot raise
+                # their own tier (see job_manager.enqueue_job)
+                job_manager.enqueue_job(
+                    job_id, filename,
+                    user_sub=user.get("sub"),
+                    size_bytes=os.path.getsize(store_fn)
+                )
+                log_event("Parser", "INFO", "Uploaded file: %s (sub=%s)", filename, user.get("sub"))
                 msg = f"Job queued: {job_id}"
         return render_template("upload.html", user=user, msg=msg)
 
@@ -301,8 +306,8 @@ def create_app():
             return user
 
         start_time = time.time()
-        logger.info(f"Query-UI: Method={request.method}, User={user.get('sub')}, IP={request.remote_addr}")
-        log_to_central("Query-UI", "INFO", f"Query-UI: Method={request.method}, User={user.get('sub')}, IP={request.remote_addr}")
+        log_event("Query-UI", "INFO", "Query-UI: Method=%s, User=%s, IP=%s",
+                  request.method, user.get('sub'), request.remote_addr)
 
         answer = None
         question = ""
@@ -311,21 +316,19 @@ def create_app():
         if request.method == "POST":
             question = request.form.get("question", "").strip()
             model = request.form.get("model", "openai").lower()
-            logger.info(f"Query from UI: '{question}' [model={model}]")
-            log_to_central("Query-UI", "INFO", f"Received question: {question}")
+            log_event("Query-UI", "INFO", "Query from UI: '%s' [model=%s]", question, model)
 
-            with sqlite3.connect(DB_PATH) as conn:
+            with db.get_conn(db.JOBS_DB) as conn:
                 rows = conn.execute(
                     "SELECT result FROM jobs WHERE status='complete' AND result IS NOT NULL"
                 ).fetchall()
-                logger.info(f"Query-UI: {len(rows)} complete docs found for context.")
-                log_to_central("Query-UI", "INFO", f"Query-UI: {len(rows)} complete docs found for context.")
+                log_event("Query-UI", "INFO", "Query-UI: %d complete docs found for context.", len(rows))
                 context = "\n\n".join(r[0] for r in rows)
-                log_to_central("Query-UI", "INFO", f"Query-UI: Context: {context}")
+                log_event("Query-UI", "DEBUG", "Query-UI: Context: %s", context)
 
             if not context.strip():
                 answer = "No documents found. Please upload and process files before querying."
-                log_to_central("Query-UI", "INFO", "No documents found. Please upload and process files before querying.")
+                log_event("Query-UI", "INFO", "No documents found. Please upload and process files before querying.")
             else:
                 if model == "ollama":
                     # Route to Ollama local instance
@@ -375,7 +378,7 @@ def create_app():
         import warnings
         warnings.warn("LOGS endpoint is currently public! Remove this before production.")
 
-        with sqlite3.connect("logs.db") as conn:
+        with db.get_conn(db.LOGS_DB) as conn:
             raw = conn.execute(
                 "SELECT service, level, message, created_at "
                 "FROM logs ORDER BY created_at DESC LIMIT 200"
@@ -398,7 +401,7 @@ def create_app():
         import pytz
         from datetime import datetime
         PACIFIC = pytz.timezone("America/Los_Angeles")
-        with sqlite3.connect("logs.db") as conn:
+        with db.get_conn(db.LOGS_DB) as conn:
             rows = conn.execute(
                 "SELECT service, level, message, created_at FROM logs ORDER BY created_at DESC LIMIT 100"
             ).fetchall()
@@ -415,9 +418,25 @@ def create_app():
 
 
 
+    @app.route("/queue-stats.json")
+    def queue_stats_json():
+        # The caller's own queue wait times plus anonymized totals across all
+        # users, to check fair-share scheduling under load
+        user = require_login()
+        if not isinstance(user, dict): return user
+        hours = request.args.get("hours", 24, type=int)
+        return jsonify(job_manager.queue_wait_summary(user.get("sub"), window_hours=hours))
+
     @app.route("/ping")
     def ping():
-        req_id = str(uuid.uuid4())
+        # Rate-limited (or disabled) ping lines skip building the log entry entirely
+        if not logger.isEnabledFor(logging.INFO):
+            return "OK", 200
+        allowed, suppressed = ping_limit.allow("ping") if ping_limit else (True, 0)
+        if not allowed:
+            return "OK", 200
+
+        req_id = get_trace_id()
         ts = time.time()
         ip = request.headers.get("X-Forwarded-For", request.remote_addr)
         ua = request.headers.get("User-Agent", "-")
@@ -433,12 +452,12 @@ def create_app():
             "params": params,
             "headers": {k: v for k, v in headers.items() if k.lower() not in ["cookie", "authorization"]},
             "session_id": session_id,
-            "timestamp": ts
+            "timestamp": ts,
+            "suppressed": suppressed
         }
 
         # Local and central logging
-        logger.info(f"[ping] {log_entry}")
-        log_to_central("API Gateway", "INFO", f"[ping] {log_entry}")
+        log_event("API Gateway", "INFO", "[ping] %s", log_entry)
 
         # TODO: Implement rate limiting/DDoS block logic here.
 
@@ -462,19 +481,6 @@ JWT_SECRET_KEY = get_required_env("JWT_SECRET_KEY")
 FLASK_SECRET_KEY = get_required_env("FLASK_SECRET_KEY")
 OPENAI_API_KEY = get_required_env("OPENAI_API_KEY")
 
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS jobs (
-                id TEXT PRIMARY KEY,
-                filename TEXT,
-                status TEXT,
-                result TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
 if __name__ == "__main__":
-    init_db()
     app = create_app()
     app.run(host="127.0.0.1", port=5000, debug=True)
@@ -43,3 +43,15 @@ ALLOWED_REDIRECT_URIS = [
 OIDC_AUTH_URL = get_env("OIDC_AUTH_URL", "https://aurorahours.com/identity-backend/authorize")
 OIDC_TOKEN_URL = get_env("OIDC_TOKEN_URL", "https://aurorahours.com/identity-backend/token")
 OIDC_REDIRECT_URI = get_env("OIDC_REDIRECT_URI", "http://localhost:5000/callback")
+
+# --- SQLite storage ---
+JOBS_DB_PATH = get_env("JOBS_DB_PATH", "jobs.db")
+LOGS_DB_PATH = get_env("LOGS_DB_PATH", "logs.db")
+SQLITE_BUSY_TIMEOUT_MS = int(get_env("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(get_env("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_CACHED_STATEMENTS = int(get_env("SQLITE_CACHED_STATEMENTS", "256"))
+
+# --- Job scheduling (job_manager.py) ---
+SCHED_DEFAULT_WEIGHT = float(get_env("SCHED_DEFAULT_WEIGHT", "1.0"))
+SCHED_COST_UNIT_BYTES = int(get_env("SCHED_COST_UNIT_BYTES", str(1024 * 1024)))
+SCHED_MAX_WAIT_SECS = int(get_env("SCHED_MAX_WAIT_SECS", "3600"))
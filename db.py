@@ -0,0 +1,175 @@
+# db.py
+# Shared SQLite access for the gateway, worker and logging service.
+#
+# Each thread gets one long-lived connection per database file, opened with
+# WAL journaling, synchronous=NORMAL, a busy timeout and mmap reads. Schemas
+# and indexes are migrated once at import, so every service (and every WSGI
+# worker process) starts against the same layout.
+#
+# Pooling pays off only where threads are reused (gunicorn sync/gthread
+# workers, the worker loop). Werkzeug's dev server starts a thread per
+# request, so there each request still opens its own connection.
+
+import atexit
+import os
+import sqlite3
+import threading
+
+import config
+
+JOBS_DB = config.JOBS_DB_PATH
+LOGS_DB = config.LOGS_DB_PATH
+
+# Logical database name -> file. Both may point at the same file; each name
+# keeps its own migration version.
+DATABASES = {
+    "jobs": JOBS_DB,
+    "logs": LOGS_DB,
+}
+
+_local = threading.local()
+
+# Ordered migrations per logical database. Append new steps to the end of a
+# list; never edit a step that has shipped. The schema_version table in each
+# file records how many steps of each list have been applied.
+MIGRATIONS = {
+    "jobs": [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            status TEXT,
+            result TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            id TEXT PRIMARY KEY,
+            job_id TEXT,
+            chunk_index INTEGER,
+            chunk_text TEXT,
+            embedding BLOB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_embeddings_job ON embeddings (job_id, chunk_index)",
+        # Scheduling metadata (see job_manager.py)
+        "ALTER TABLE jobs ADD COLUMN user_sub TEXT NOT NULL DEFAULT 'anonymous'",
+        "ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE jobs ADD COLUMN size_bytes INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE jobs ADD COLUMN size_class INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE jobs ADD COLUMN started_at TIMESTAMP",
+        "ALTER TABLE jobs ADD COLUMN finished_at TIMESTAMP",
+        '''
+        CREATE TABLE IF NOT EXISTS fair_share (
+            user_sub TEXT PRIMARY KEY,
+            weight REAL NOT NULL DEFAULT 1.0,
+            vtime REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        "INSERT OR IGNORE INTO fair_share (user_sub) SELECT DISTINCT user_sub FROM jobs",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_claim_size ON jobs (status, priority, user_sub, size_class, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_claim_age ON jobs (status, priority, user_sub, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_fair_share_vtime ON fair_share (vtime)",
+    ],
+    "logs": [
+        '''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY,
+            service TEXT,
+            level TEXT,
+            message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_logs_created ON logs (created_at)",
+    ],
+}
+
+
+def _open(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=config.SQLITE_CACHED_STATEMENTS,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS:d}")
+    conn.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE:d}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def get_conn(path=JOBS_DB):
+    """Return this thread's pooled connection to `path`.
+
+    Use it like a plain sqlite3 connection: `with get_conn() as conn:` commits
+    on success and rolls back on error, but leaves the connection open for
+    reuse. Connections inherited across a fork (e.g. gunicorn/uWSGI preload)
+    are discarded, so each worker process opens its own.
+    """
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        _local.pid = pid
+        _local.conns = {}
+    conn = _local.conns.get(path)
+    if conn is None:
+        conn = _open(path)
+        _local.conns[path] = conn
+    return conn
+
+
+def close_all():
+    """Close every connection owned by the calling thread.
+
+    Registered with atexit for the main thread (worker loop, service
+    shutdown); connections of other threads close when the thread exits.
+    """
+    conns = getattr(_local, "conns", None) or {}
+    if getattr(_local, "pid", None) == os.getpid():
+        for conn in conns.values():
+            conn.close()
+    _local.conns = {}
+
+
+def migrate(name):
+    """Apply any pending MIGRATIONS[name] steps to its database file."""
+    steps = MIGRATIONS[name]
+    conn = _open(DATABASES[name])
+    try:
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent
+        # services starting together apply each step exactly once.
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            row = conn.execute(
+                "SELECT version FROM schema_version WHERE name = ?", (name,)
+            ).fetchone()
+            version = row[0] if row else 0
+            for step in steps[version:]:
+                conn.execute(step)
+            if version < len(steps):
+                conn.execute(
+                    "INSERT OR REPLACE INTO schema_version (name, version) VALUES (?, ?)",
+                    (name, len(steps)),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+for _name in MIGRATIONS:
+    migrate(_name)
+
+atexit.register(close_all)
@@ -0,0 +1,243 @@
+# job_manager.py
+# Job queue scheduling: priorities, weighted fair share across users and
+# size-aware ordering.
+#
+# Claim order:
+#   1. Effective priority tiers. The top tier is the highest priority with
+#      queued work. A lower-priority job is aged up one tier for every
+#      SCHED_MAX_WAIT_SECS it has waited, capped at the top tier, so LOW work
+#      is never starved by a steady stream of higher-priority uploads. Aging
+#      never lifts a job above the top tier: an old backlog competes on equal
+#      terms with fresh work of the same tier.
+#   2. Among users with work in the top tier, the user with the lowest
+#      virtual time (weighted fair queuing). Claiming a job advances the
+#      user's virtual time by the job's cost (1 + size in
+#      SCHED_COST_UNIT_BYTES) divided by their weight, so a bulk upload only
+#      gets its share while other users are waiting, however old it is.
+#   3. Within that user's eligible jobs, the smallest size class first,
+#      oldest first inside a class.
+#
+# Uploads enter at PRIORITY_NORMAL; other tiers are for trusted callers of
+# enqueue_job only, never for user input.
+#
+# Every step is served by the idx_jobs_claim_* / idx_fair_share_vtime indexes
+# (see db.py), so claiming stays O(users * tiers * log jobs) as the queue grows.
+
+import config
+import db
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+ANONYMOUS = "anonymous"
+
+# Size classes grow by 16x from 256 KB: <256K, <4M, <64M, <1G, ...
+_SIZE_CLASS_BASE = 256 * 1024
+
+
+def size_class(size_bytes):
+    cls, limit = 0, _SIZE_CLASS_BASE
+    while size_bytes >= limit:
+        cls += 1
+        limit *= 16
+    return cls
+
+
+def _job_cost(size_bytes):
+    return 1.0 + size_bytes / config.SCHED_COST_UNIT_BYTES
+
+
+def enqueue_job(job_id, filename, user_sub=None, size_bytes=0, priority=PRIORITY_NORMAL):
+    user_sub = user_sub or ANONYMOUS
+    conn = db.get_conn(db.JOBS_DB)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT OR IGNORE INTO fair_share (user_sub, weight) VALUES (?, ?)",
+            (user_sub, config.SCHED_DEFAULT_WEIGHT),
+        )
+        # A user who was idle must not bank credit: bring their virtual time up
+        # to the slowest user who is currently waiting.
+        conn.execute(
+            """
+            UPDATE fair_share SET vtime = MAX(vtime, COALESCE((
+                SELECT MIN(f.vtime) FROM fair_share f
+                WHERE f.user_sub != :sub AND EXISTS (
+                    SELECT 1 FROM jobs j WHERE j.status = 'queued' AND j.user_sub = f.user_sub
+                )
+            ), vtime))
+            WHERE user_sub = :sub AND NOT EXISTS (
+                SELECT 1 FROM jobs j WHERE j.status = 'queued' AND j.user_sub = :sub
+            )
+            """,
+            {"sub": user_sub},
+        )
+        conn.execute(
+            "INSERT INTO jobs (id, filename, status, user_sub, priority, size_bytes, size_class) "
+            "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, filename, user_sub, priority, size_bytes, size_class(size_bytes)),
+        )
+
+
+def _eligible_tiers(conn):
+    """Return [(priority, age_cutoff)] making up the current top tier.
+
+    The first entry is the top priority itself (any age); each lower priority
+    k tiers down is eligible once it has waited k * SCHED_MAX_WAIT_SECS.
+    """
+    # Separate MAX/MIN queries so each is a single index seek
+    top = conn.execute("SELECT MAX(priority) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    if top is None:
+        return []
+    bottom = conn.execute("SELECT MIN(priority) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    tiers = [(top, None)]
+    for k in range(1, top - bottom + 1):
+        tiers.append((top - k, f"-{k * config.SCHED_MAX_WAIT_SECS:d} seconds"))
+    return tiers
+
+
+def _tier_filter(user_expr, priority, cutoff):
+    """SQL filter (and its params) for queued jobs of `user_expr` in one tier."""
+    sql = f"j.status = 'queued' AND j.user_sub = {user_expr} AND j.priority = ?"
+    params = [priority]
+    if cutoff is not None:
+        sql += " AND j.created_at <= datetime('now', ?)"
+        params.append(cutoff)
+    return sql, params
+
+
+def claim_next_job():
+    """Atomically pick the next job and mark it running.
+
+    Returns (job_id, filename) or None if nothing is queued. Safe to call from
+    several workers at once: the claim runs under BEGIN IMMEDIATE.
+    """
+    conn = db.get_conn(db.JOBS_DB)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        tiers = _eligible_tiers(conn)
+        if not tiers:
+            return None
+
+        clauses, params = [], []
+        for priority, cutoff in tiers:
+            sql, tier_params = _tier_filter("f.user_sub", priority, cutoff)
+            clauses.append(f"EXISTS (SELECT 1 FROM jobs j WHERE {sql})")
+            params += tier_params
+        user = conn.execute(
+            f"SELECT f.user_sub, f.weight FROM fair_share f WHERE {' OR '.join(clauses)} "
+            "ORDER BY f.vtime, f.user_sub LIMIT 1",
+            params,
+        ).fetchone()
+        if user is None:
+            return None
+        user_sub, weight = user
+
+        # Best candidate per eligible priority, then the smallest/oldest overall
+        candidates = []
+        for priority, cutoff in tiers:
+            sql, tier_params = _tier_filter("?", priority, cutoff)
+            row = conn.execute(
+                "SELECT j.size_class, j.created_at, j.id, j.filename, j.size_bytes FROM jobs j "
+                f"WHERE {sql} ORDER BY j.size_class, j.created_at LIMIT 1",
+                [user_sub] + tier_params,
+            ).fetchone()
+            if row is not None:
+                candidates.append(row)
+        _, _, job_id, filename, size_bytes = min(candidates)
+
+        conn.execute(
+            "UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (job_id,),
+        )
+        conn.execute(
+            "UPDATE fair_share SET vtime = vtime + ? WHERE user_sub = ?",
+            (_job_cost(size_bytes) / (weight or config.SCHED_DEFAULT_WEIGHT), user_sub),
+        )
+    return job_id, filename
+
+
+def finish_job(job_id, status, result=None):
+    with db.get_conn(db.JOBS_DB) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = COALESCE(?, result), "
+            "finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, result, job_id),
+        )
+
+
+def set_user_weight(user_sub, weight):
+    """Give `user_sub` `weight` times the default share of the queue."""
+    with db.get_conn(db.JOBS_DB) as conn:
+        conn.execute(
+            "INSERT INTO fair_share (user_sub, weight) VALUES (?, ?) "
+            "ON CONFLICT(user_sub) DO UPDATE SET weight = excluded.weight",
+            (user_sub, weight),
+        )
+
+
+def queue_wait_stats(window_hours=24):
+    """Per-user queue wait times for jobs submitted in the last `window_hours`.
+
+    Waits are in seconds; `oldest_queued_secs` is how long the user's oldest
+    still-queued job has been waiting.
+    """
+    with db.get_conn(db.JOBS_DB) as conn:
+        rows = conn.execute(
+            """
+            SELECT j.user_sub,
+                   COALESCE(f.weight, ?),
+                   SUM(j.status = 'queued'),
+                   SUM(j.status = 'running'),
+                   SUM(j.started_at IS NOT NULL),
+                   AVG((julianday(j.started_at) - julianday(j.created_at)) * 86400),
+                   MAX((julianday(j.started_at) - julianday(j.created_at)) * 86400),
+                   MAX(CASE WHEN j.status = 'queued'
+                       THEN (julianday('now') - julianday(j.created_at)) * 86400 END)
+            FROM jobs j LEFT JOIN fair_share f ON f.user_sub = j.user_sub
+            WHERE j.created_at >= datetime('now', ?)
+            GROUP BY j.user_sub
+            ORDER BY j.user_sub
+            """,
+            (config.SCHED_DEFAULT_WEIGHT, f"-{int(window_hours):d} hours"),
+        ).fetchall()
+    return [
+        {
+            "user_sub": sub,
+            "weight": weight,
+            "queued": queued,
+            "running": running,
+            "started": started,
+            "avg_wait_secs": round(avg_wait, 3) if avg_wait is not None else None,
+            "max_wait_secs": round(max_wait, 3) if max_wait is not None else None,
+            "oldest_queued_secs": round(oldest, 3) if oldest is not None else None,
+        }
+        for sub, weight, queued, running, started, avg_wait, max_wait, oldest in rows
+    ]
+
+
+def queue_wait_summary(user_sub, window_hours=24):
+    """`user_sub`'s own row from queue_wait_stats plus totals across all users.
+
+    Safe to show to any logged-in user: other users' subs and per-user
+    counts are not included.
+    """
+    rows = queue_wait_stats(window_hours)
+    own = next((row for row in rows if row["user_sub"] == user_sub), None)
+    started = sum(row["started"] for row in rows)
+    waited = sum(row["avg_wait_secs"] * row["started"] for row in rows if row["started"])
+    max_waits = [row["max_wait_secs"] for row in rows if row["max_wait_secs"] is not None]
+    oldest = [row["oldest_queued_secs"] for row in rows if row["oldest_queued_secs"] is not None]
+    return {
+        "you": own,
+        "all_users": {
+            "users": len(rows),
+            "queued": sum(row["queued"] for row in rows),
+            "running": sum(row["running"] for row in rows),
+            "started": started,
+            "avg_wait_secs": round(waited / started, 3) if started else None,
+            "max_wait_secs": max(max_waits) if max_waits else None,
+            "oldest_queued_secs": max(oldest) if oldest else None,
+        },
+    }
@@ -1,21 +1,283 @@
+import atexit
+import contextvars
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import random
 import sys
+import threading
+import time
+import uuid
 
-def setup_logging(service_name="MVP"):
+import requests
+
+# Trace id for the current request/job; set it once at the edge and every
+# record logged from the same thread or task carries it.
+_trace_id = contextvars.ContextVar("trace_id", default="-")
+
+# Attributes every LogRecord has; anything else came in via `extra=` and is
+# emitted as a structured field by JsonFormatter.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "trace_id", "service",
+}
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def set_trace_id(trace_id=None):
+    """Bind `trace_id` (or a fresh one) to the current context and return it."""
+    trace_id = trace_id or new_trace_id()
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def get_trace_id():
+    return _trace_id.get()
+
+
+def clear_trace_id():
+    """Drop the current context's trace id back to the default "-"."""
+    _trace_id.set("-")
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the service name and the caller's trace id.
+
+    Runs on the caller's thread (before the record is queued), which is the
+    only place the context variable is visible.
+    """
+
+    def __init__(self, service_name):
+        super().__init__()
+        self.service_name = service_name
+
+    def filter(self, record):
+        record.service = self.service_name
+        record.trace_id = _trace_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep roughly `rate` of the records at or below `max_level`.
+
+    Records above `max_level` always pass, so sampling DEBUG/INFO chatter
+    never hides warnings or errors.
+    """
+
+    def __init__(self, rate, max_level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        if record.levelno > self.max_level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class RateLimitFilter(logging.Filter):
+    """Allow at most `limit` records per message template every `interval` seconds.
+
+    Keys on the unformatted template (`record.msg`), so a noisy line with
+    changing arguments is throttled as one message while distinct messages
+    are counted separately. The first record through after a suppressed
+    window carries `suppressed=<count>`. Expired windows are swept once per
+    interval, so the key table only holds recently seen templates.
+    """
+
+    def __init__(self, limit, interval=60.0, max_level=logging.INFO):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.max_level = max_level
+        self._windows = {}
+        self._next_sweep = time.monotonic() + interval
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Count one event for `key`; return (allowed, suppressed_before)."""
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._windows = {
+                    k: w for k, w in self._windows.items() if now - w[0] < self.interval
+                }
+                self._next_sweep = now + self.interval
+            start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count < self.limit:
+                self._windows[key] = (start, count + 1, 0)
+                return True, suppressed
+            self._windows[key] = (start, count, suppressed + 1)
+            return False, 0
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        allowed, suppressed = self.allow((record.name, record.msg))
+        if suppressed:
+            record.suppressed = suppressed
+        return allowed
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any `extra=` fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": getattr(record, "service", record.name),
+            "trace_id": getattr(record, "trace_id", "-"),
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class CentralLogHandler(logging.Handler):
+    """Forward records to the central logging service (POST /log).
+
+    Only records logged with `extra={"central_service": ...}` are sent, under
+    that service name. It runs behind the queue like the console and file
+    handlers, so records dropped by level, sampling or rate limits are never
+    formatted or posted, and the HTTP call happens on the listener thread
+    rather than the request thread.
+    """
+
+    def __init__(self, url, timeout=2):
+        super().__init__()
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def emit(self, record):
+        service = getattr(record, "central_service", None)
+        if service is None:
+            return
+        try:
+            self.session.post(
+                self.url,
+                json={
+                    "service": service,
+                    "level": record.levelname,
+                    "message": record.getMessage(),
+                    "trace_id": getattr(record, "trace_id", "-"),
+                },
+                timeout=self.timeout,
+            )
+        except Exception as e:
+            # Logged without central_service, so this never loops back here
+            logging.getLogger(getattr(record, "service", record.name)).error(
+                "Failed to log to central: %s", e
+            )
+
+    def close(self):
+        self.session.close()
+        super().close()
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers all formatting to the listener thread.
+
+    The stock prepare() formats the message on the caller's thread; the queue
+    here never leaves the process, so the record is enqueued untouched and
+    %-args are only rendered if a handler actually writes it.
+    """
+
+    def __init__(self, service_name, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.service_name = service_name
+        self.target_handlers = handlers
+        self._start_listener()
+
+    def _start_listener(self, new_queue=True):
+        if new_queue:
+            self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *self.target_handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self.queue.put_nowait(record)
+
+    def stop(self):
+        self.listener.stop()
+        for handler in self.target_handlers:
+            handler.close()
+
+
+def _stop_all():
+    with _listeners_lock:
+        for handler in _listeners.values():
+            handler.stop()
+        _listeners.clear()
+
+
+def _drain_before_fork():
+    # Stop (and drain) the listener threads so none of them is inside a
+    # handler's write when the process forks (gunicorn/uWSGI preload);
+    # otherwise the child inherits a held stream lock on the log file.
+    _listeners_lock.acquire()
+    for handler in _listeners.values():
+        handler.listener.stop()
+
+
+def _restart_in_parent():
+    # Records queued while the listener was stopped are still in the queue.
+    for handler in _listeners.values():
+        handler._start_listener(new_queue=False)
+    _listeners_lock.release()
+
+
+def _restart_in_child():
+    global _listeners_lock
+    _listeners_lock = threading.Lock()
+    for handler in _listeners.values():
+        handler._start_listener()
+
+
+atexit.register(_stop_all)
+os.register_at_fork(
+    before=_drain_before_fork,
+    after_in_parent=_restart_in_parent,
+    after_in_child=_restart_in_child,
+)
+
+
+def setup_logging(service_name="MVP", sample_rate=None, rate_limit=None, central_url=None):
     logger = logging.getLogger(service_name)
-    
+
     # Set log level from env or default INFO
     log_level_name = os.getenv("LOG_LEVEL", "INFO").upper()
     log_level = getattr(logging, log_level_name, logging.INFO)
     logger.setLevel(log_level)
 
-    # Formatter for all handlers
-    formatter = logging.Formatter(
-        "%(asctime)s %(levelname)s %(name)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
+    # Formatter for all handlers: LOG_FORMAT=json for structured records
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(trace_id)s] - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
 
     # Console handler (stderr)
     console_handler = logging.StreamHandler(sys.stderr)
@@ -30,12 +292,41 @@ def setup_logging(service_name="MVP"):
     file_handler.setLevel(log_level)
     file_handler.setFormatter(formatter)
 
-    # Remove existing handlers to avoid duplicates
+    handlers = [console_handler, file_handler]
+
+    # Optional forwarding to the central logging service (see CentralLogHandler)
+    if central_url:
+        central_handler = CentralLogHandler(central_url)
+        central_handler.setLevel(log_level)
+        handlers.append(central_handler)
+
+    # Remove existing handlers/filters to avoid duplicates
+    with _listeners_lock:
+        previous = _listeners.pop(service_name, None)
+    if previous is not None:
+        previous.stop()
     if logger.hasHandlers():
         logger.handlers.clear()
+    logger.filters.clear()
+
+    # Console, file and central I/O happen on a background listener thread;
+    # the calling thread only stamps context and enqueues the record.
+    queue_handler = _AsyncQueueHandler(service_name, handlers)
+    queue_handler.addFilter(ContextFilter(service_name))
+    logger.addHandler(queue_handler)
+    with _listeners_lock:
+        _listeners[service_name] = queue_handler
 
-    # Add handlers
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # Optional sampling/rate limiting for this logger (LOG_SAMPLE_RATE is the
+    # fraction of DEBUG records kept, LOG_RATE_LIMIT the per-minute cap for
+    # each INFO-or-lower message template; 0 disables it).
+    if sample_rate is None:
+        sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+    if rate_limit is None:
+        rate_limit = int(os.getenv("LOG_RATE_LIMIT", "0"))
+    if sample_rate < 1:
+        logger.addFilter(SamplingFilter(sample_rate))
+    if rate_limit > 0:
+        logger.addFilter(RateLimitFilter(rate_limit))
 
     return logger
@@ -1,6 +1,6 @@
 import time
-import sqlite3
-from log_utils import setup_logging
+import job_manager
+from log_utils import setup_logging, set_trace_id, clear_trace_id
 import requests
 import os
 from dotenv import load_dotenv
@@ -8,24 +8,6 @@ import traceback
 
 load_dotenv()
 
-DB = "jobs.db"  
-
-def init_embedding_db():
-    with sqlite3.connect(DB) as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS embeddings (
-                id TEXT PRIMARY KEY,
-                job_id TEXT,
-                chunk_index INTEGER,
-                chunk_text TEXT,
-                embedding BLOB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-if __name__ == "__main__":
-    init_embedding_db()
-
 def log_to_central(service, level, message):
     try:
         requests.post(
@@ -34,7 +16,7 @@ def log_to_central(service, level, message):
             timeout=2
         )
     except Exception as e:
-        logger.error(f"Failed to log to central: {e}")
+        logger.error("Failed to log to central: %s", e)
 
 UPLOAD_DIR = "doc_store"
 logger = setup_logging("Worker")
@@ -42,16 +24,12 @@ PARSER_URL = "http://localhost:5010/parse"
 
 while True:
     logger.debug("Checking for queued jobs...")
-    with sqlite3.connect(DB) as conn:
-        job = conn.execute(
-            "SELECT id, filename FROM jobs WHERE status='queued' ORDER BY created_at LIMIT 1"
-        ).fetchone()
+    job = job_manager.claim_next_job()
 
     if job:
         job_id, filename = job
-        with sqlite3.connect(DB) as conn:
-            conn.execute("UPDATE jobs SET status=? WHERE id=?", ("running", job_id))
-        logger.info(f"Processing job {job_id} - file: {filename}")
+        set_trace_id(job_id)
+        logger.info("Processing job %s - file: %s", job_id, filename)
         log_to_central("Parser", "INFO", f"Processing job {job_id}")
 
         try:
@@ -63,26 +41,25 @@ while True:
                 size = len(parsed)
                 snippet = parsed[:500].replace("\n", " ")  
 
-                with sqlite3.connect(DB) as conn:
-                    conn.execute("UPDATE jobs SET status=?, result=? WHERE id=?", ("complete", parsed[:10000], job_id))
+                job_manager.finish_job(job_id, "complete", parsed[:10000])
 
-                logger.info(f"Job {job_id} complete. Parsed text size: {size} chars. Snippet: {snippet}")
+                logger.info("Job %s complete. Parsed text size: %d chars. Snippet: %s", job_id, size, snippet)
                 log_to_central("Parser", "INFO", f"Job {job_id} complete. Parsed text size: {size}. Snippet: {snippet}")
 
             else:
-                with sqlite3.connect(DB) as conn:
-                    conn.execute("UPDATE jobs SET status=? WHERE id=?", ("failed", job_id))
-                logger.error(f"Job {job_id} failed with HTTP status {resp.status_code}. Response: {resp.text}")
+                job_manager.finish_job(job_id, "failed")
+                logger.error("Job %s failed with HTTP status %s. Response: %s", job_id, resp.status_code, resp.text)
                 log_to_central("Parser", "ERROR", f"Job {job_id} failed. HTTP {resp.status_code}: {resp.text}")
 
         except Exception as e:
-            with sqlite3.connect(DB) as conn:
-                conn.execute("UPDATE jobs SET status=? WHERE id=?", ("failed", job_id))
+            job_manager.finish_job(job_id, "failed")
             tb_str = traceback.format_exc()
-            logger.error(f"Job {job_id} failed with exception: {str(e)}", exc_info=True)
+            logger.error("Job %s failed with exception: %s", job_id, e, exc_info=True)
             log_to_central("Parser", "ERROR", f"Job {job_id} failed with exception: {str(e)}\nTraceback:\n{tb_str}")
 
     else:
         logger.debug("No queued jobs found, worker sleeping...")
 
+    clear_trace_id()
+
     time.sleep(5)